@@ -1,19 +1,36 @@
 import argparse
 import asyncio
+import functools
+import gzip
+import itertools
 import os
 import random
+import re
 import sqlite3
 import tempfile
 import zipfile
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from pathlib import Path
 from typing import TypedDict
-from urllib.parse import urlparse
 
 import genanki
+import lxml.html
+import msgspec
 import nodriver as uc
-from bs4 import BeautifulSoup, Tag
+import orjson
+from bs4 import Tag
+from lxml import etree
+from lxml.html import HtmlElement
 from pypinyin import Style, pinyin
 
-from templates import INVALID_EXAMPLE_MODEL, TRANSLATION_MODEL, VALID_EXAMPLE_MODEL
+from templates import (
+    INVALID_EXAMPLE_MODEL_ID,
+    TRANSLATION_MODEL_ID,
+    VALID_EXAMPLE_MODEL_ID,
+    get_model_by_id,
+)
 
 # Constants
 
@@ -22,6 +39,11 @@ from templates import INVALID_EXAMPLE_MODEL, TRANSLATION_MODEL, VALID_EXAMPLE_MO
 DECK_ID = 1111957820
 DECK_NAME = "Chinese Grammar Wiki Examples"
 DEFAULT_DECK_LOCATION="decks/cgw_examples.apkg"
+# browser profile kept between runs, and where Chrome keeps the cookies inside it (moved in newer versions)
+BROWSER_PROFILE_DIR = ".browser_profile"
+BROWSER_COOKIES_PATHS = [("Default", "Network", "Cookies"), ("Default", "Cookies")]
+# scraped pages are stored as gzipped JSON lines in this file inside --cache-dir
+PAGE_CACHE_FILENAME = "pages.jsonl.gz"
 BASE_URL = "https://resources.allsetlearning.com/chinese/grammar/"
 
 LEVELS_URLS = [
@@ -33,10 +55,33 @@ LEVELS_URLS = [
         # add the below when it's populated:
         # "https://resources.allsetlearning.com/chinese/grammar/C2_grammar_points"
     ]
+LEVELS_URLS_LOWER = frozenset(url.lower() for url in LEVELS_URLS)
+# any page on the grammar wiki; point pages are named by code (e.g. ASGH4A7W) or by title, so allow any page name
+CGW_URL_RE = re.compile(rf"{re.escape(BASE_URL)}\S+")
 # some pages are malformed or unfinished; ignore them
 BLOCKLIST = [
     "https://resources.allsetlearning.com/chinese/grammar/ASGH4A7W"
 ]
+BLOCKLIST_SET = frozenset(BLOCKLIST)
+# number of tabs fetching pages at once; each tab still rate limits itself between pages
+MAX_CONCURRENT_TABS = 4
+
+# point pages handed to each parsing worker at a time; larger chunks mean less inter-process overhead per page
+PARSE_CHUNKSIZE = 16
+
+WHITESPACE_RE = re.compile(r'\s+')
+# the structure and example divs on a point page, in document order, i.e. "div.jiegou, div.liju"
+STRUCTURE_AND_EXAMPLE_DIVS_XPATH = etree.XPath(
+    '//div[contains(concat(" ", normalize-space(@class), " "), " jiegou ")'
+    ' or contains(concat(" ", normalize-space(@class), " "), " liju ")]'
+)
+# classes of the spans holding the optional parts of an example
+LI_COMPONENT_CLASSES = frozenset(["pinyin", "trans", "expl"])
+# titles of the grammar point links in the tables on a level page, i.e. "table.wikitable a.mw-redirect"
+POINT_LINK_TITLES_XPATH = etree.XPath(
+    '//table[contains(concat(" ", normalize-space(@class), " "), " wikitable ")]'
+    '//a[contains(concat(" ", normalize-space(@class), " "), " mw-redirect ")]/@title'
+)
 
 # Types and Type Aliases
 Url = str
@@ -44,8 +89,11 @@ PageContent = str
 class UrlAndPageContent(TypedDict):
     url: Url
     content: PageContent
-class CardContent(TypedDict):
-    model: str
+# cards only hold strings and a model ID, so they can never be part of a reference cycle;
+# gc=False keeps the garbage collector from tracking (and repeatedly scanning) every scraped card
+class CardContent(msgspec.Struct, gc=False):
+    # the model is kept by ID, as cards are pickled back from the parsing workers and the models must stay shared
+    model_id: int
     hanzi: str
     pinyin: str
     translation: str
@@ -53,29 +101,32 @@ class CardContent(TypedDict):
     structure: str
     url: str
     article_title: str
+# (pinyin, translation) of a note already in the deck, stripped of surrounding whitespace
+PinyinAndTranslation = tuple[str, str]
 class DeckDiffStats(TypedDict):
     new: int
     update: int
     skipped: int
+    duplicate: int
 
 
 
 def is_valid_cgw_url(url: Url):
-    """Checks if a string is a valid CGW URL with a scheme and network location."""
-    try:
-        result = urlparse(url)
-        # Check if both scheme (e.g., http) and netloc (e.g., google.com) exist
-        # and that it's (roughly) a CGW grammar point page
-        if (all([result.scheme, result.netloc])
-            and BASE_URL in url and url.lower() not in [level.lower() for level in LEVELS_URLS]):
-            return url
-        raise ValueError
-    except ValueError:
-        raise argparse.ArgumentTypeError(f"Invalid URL: '{url}'. Must be a valid grammar point page from Chinese Grammar Wiki.")
+    """Checks if a string is a valid CGW grammar point URL."""
+    # one precompiled match for the scheme, host and path, and that it's (roughly) a CGW grammar point page
+    if CGW_URL_RE.fullmatch(url) and url.lower() not in LEVELS_URLS_LOWER:
+        return url
+    raise argparse.ArgumentTypeError(f"Invalid URL: '{url}'. Must be a valid grammar point page from Chinese Grammar Wiki.")
+
+
+def has_saved_browser_session() -> bool:
+    """Checks if a previous run left a browser profile with cookies, i.e. Cloudflare has already verified us."""
+    return any(os.path.exists(os.path.join(BROWSER_PROFILE_DIR, *cookies_path)) for cookies_path in BROWSER_COOKIES_PATHS)
 
 
 async def open_browser():
-    return await uc.start()
+    # persist the profile so the Cloudflare verification cookie survives between runs
+    return await uc.start(user_data_dir=BROWSER_PROFILE_DIR)
 
 
 def close_browser(browser):
@@ -93,69 +144,133 @@ async def human_scroll(page):
         pass
 
 
-async def get_with_verification(browser, urls: list[Url], is_test=False) -> list[UrlAndPageContent]:
-    url_and_pages: list[UrlAndPageContent] = []
-    has_validated = False
-
-    for url in urls:
-        if is_test and url_and_pages: # breaks if there is a single result
-            break
-        if url in BLOCKLIST: # ignore blocklisted urls
-            continue
-        page = await browser.get(url)
-
-        # Cloudflare often needs a moment to 'validate' the connection
-        # Nodriver handles the wait automatically, but a small delay helps
-        if not has_validated:
-            await page.wait(6)
-            has_validated = True
+async def fetch_page(browser, url: Url, semaphore: asyncio.Semaphore, wait_for_validation=False) -> UrlAndPageContent:
+    """Fetches a single page in its own tab, holding a slot of the semaphore for the whole visit."""
+    async with semaphore:
+        page = await browser.get(url, new_tab=True)
+        # close the tab even if the visit fails, so it isn't left open while the other fetches carry on
+        try:
+            # Cloudflare often needs a moment to 'validate' the connection
+            # Nodriver handles the wait automatically, but a small delay helps
+            if wait_for_validation:
+                await page.wait(6)
+
+            content = await page.get_content()
+
+            # Rate limit & occasionally scroll to keep Cloudflare from marking us as a bot
+            if random.random() < 0.5:
+                await human_scroll(page)
+            await asyncio.sleep(random.uniform(1,4.5))
+        finally:
+            await page.close()
+
+    return {"url":url, "content":content}
+
+
+async def get_with_verification(browser, urls: list[Url], is_test=False, cache_dir: str | None = None,
+                                needs_validation=True) -> list[UrlAndPageContent]:
+    urls = [url for url in urls if url not in BLOCKLIST_SET] # ignore blocklisted urls
+    if is_test: # only fetch a single result
+        urls = urls[:1]
+
+    # only go to the network for pages we haven't already cached
+    cached_pages = read_page_cache(cache_dir) if cache_dir is not None else {}
+    urls_to_fetch = [url for url in urls if url not in cached_pages]
+    if len(urls_to_fetch) < len(urls):
+        print(f"Using {len(urls) - len(urls_to_fetch)} cached pages, fetching {len(urls_to_fetch)}.")
+
+    fetched_pages: list[UrlAndPageContent] = []
+    if urls_to_fetch:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_TABS)
+        # validate on the first page alone so the other tabs can reuse the verification cookie
+        first_page = await fetch_page(browser, urls_to_fetch[0], semaphore, wait_for_validation=needs_validation)
+        fetched_pages.append(first_page)
+        if cache_dir is not None:
+            append_to_page_cache(cache_dir, [first_page])
+
+        # cache each page as soon as it arrives, so one failed fetch doesn't throw away the rest of the run
+        for next_page in asyncio.as_completed([fetch_page(browser, url, semaphore) for url in urls_to_fetch[1:]]):
+            page = await next_page
+            fetched_pages.append(page)
+            if cache_dir is not None:
+                append_to_page_cache(cache_dir, [page])
+
+    cached_pages.update((page["url"], page["content"]) for page in fetched_pages)
+    return [{"url":url, "content":cached_pages[url]} for url in urls]
+
+
+def read_page_cache(cache_dir: str) -> dict[Url, PageContent]:
+    """Reads every page stored in the cache dir, keyed by url."""
+    cache_path = os.path.join(cache_dir, PAGE_CACHE_FILENAME)
+    if not os.path.exists(cache_path):
+        return {}
 
-        url_and_pages.append({"url":url, "content":await page.get_content()})
+    cached_pages: dict[Url, PageContent] = {}
+    # one JSON page per line, possibly spread over several appended gzip members
+    with gzip.open(cache_path, 'rb') as f:
+        for line in f:
+            page = orjson.loads(line)
+            cached_pages[page["url"]] = page["content"]
+    return cached_pages
 
-        # Rate limit & occasionally scroll to keep Cloudflare from marking us as a bot
-        if random.random() < 0.5:
-            await human_scroll(page)
-        await asyncio.sleep(random.uniform(1,4.5))
 
-    return url_and_pages
+def append_to_page_cache(cache_dir: str, url_and_pages: list[UrlAndPageContent]):
+    """Appends pages to the cache dir so later runs can skip fetching them."""
+    os.makedirs(cache_dir, exist_ok=True)
+    with gzip.open(os.path.join(cache_dir, PAGE_CACHE_FILENAME), 'ab') as f:
+        for page in url_and_pages:
+            f.write(orjson.dumps(page, option=orjson.OPT_APPEND_NEWLINE))
 
 
 def parse_level_pages(level_pages: list[UrlAndPageContent]) -> list[Url]:
     point_urls: list[Url] = []
     for page in level_pages:
-        soup = BeautifulSoup(page["content"], 'html.parser')
-        point_page_links = soup.select("table.wikitable a.mw-redirect")
-        point_urls.extend([f"{BASE_URL}{link.get("title")}" for link in point_page_links])
+        # the whole selection runs inside libxml2, with no Python-level tree walk
+        tree = lxml.html.fromstring(page["content"])
+        point_urls.extend([f"{BASE_URL}{title}" for title in POINT_LINK_TITLES_XPATH(tree)])
     return point_urls
 
 
-def parse_point_pages(url_and_point_pages) -> list[CardContent]:
-    scraped_cards = []
-    for url_and_point_page in url_and_point_pages:
-        scraped_cards.extend(parse_point_page(url_and_point_page))
-    return scraped_cards
+def parse_point_pages(url_and_point_pages: list[UrlAndPageContent]) -> list[CardContent]:
+    # a single page (e.g. in test mode) isn't worth starting worker processes for
+    if len(url_and_point_pages) <= 1:
+        return list(itertools.chain.from_iterable(map(parse_point_page, url_and_point_pages)))
 
+    # parsing is CPU-bound and independent per page, so spread the pages across all cores
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(parse_point_page, url_and_point_pages, chunksize=PARSE_CHUNKSIZE)
+        return list(itertools.chain.from_iterable(results))
 
-def parse_point_page(url_and_point_page: dict[str, str]) -> list[CardContent]:
-    soup = BeautifulSoup(url_and_point_page["content"], 'html.parser')
 
-    url = url_and_point_page["url"]
-    title = soup.find("h1").get_text(strip=True)
-    example_divs = soup.find_all("div", class_="liju")
+def parse_point_page(url_and_point_page: UrlAndPageContent) -> list[CardContent]:
+    # lxml builds and queries the tree in C, without creating a Python object per tag like BeautifulSoup does
+    tree = lxml.html.fromstring(url_and_point_page["content"])
+    # text_content() would include script & style text (bs4's get_text() skips it), so drop them but keep their tails
+    etree.strip_elements(tree, "script", "style", with_tail=False)
 
-    parsed = []
-    for div in example_divs:
-        structure_div = div.find_previous("div", class_="jiegou")
-        # some points don't have associated structures on the page
-        structure = structure_div.get_text(strip=True) if structure_div is not None else ""
+    url = url_and_point_page["url"]
+    title = get_stripped_text(tree.find(".//h1"))
+    # walk structures and examples in document order, so each example uses the closest structure above it
+    structure_and_example_divs = STRUCTURE_AND_EXAMPLE_DIVS_XPATH(tree)
+
+    parsed: list[CardContent] = []
+    # some points don't have associated structures on the page
+    structure = ""
+    for div in structure_and_example_divs:
+        if "jiegou" in div.classes:
+            # most structures are a single plain text node, so skip the itertext walk for those
+            structure = get_stripped_text(div) if len(div) else (div.text or "").strip()
+            continue
 
         # determine if it's a dialog or not
-        ul = div.find("ul")
-        is_dialog = "dialog" in ul.get("class", [])
-        lis = ul.find_all("li")
+        ul = div.find(".//ul")
+        is_dialog = "dialog" in ul.classes
+        # walk the list items lazily instead of collecting every nested li up front
+        lis = ul.iterchildren("li")
 
         if is_dialog:
-            # accumulate all the lines in the dialog
+            # accumulate all the lines in the dialog, keeping each line's speaker alongside it
+            speakers = []
             lines_hanzi = []
             lines_pinyin = []
             lines_trans = []
@@ -163,127 +278,157 @@ def parse_point_page(url_and_point_page: dict[str, str]) -> list[CardContent]:
 
             for li in lis:
                 # dialogs: group all lines into one entry
-                speaker_tag = li.find("span", class_="speaker")
+                speaker_tag = next((span for span in li.iter("span") if "speaker" in span.classes), None)
                 if speaker_tag is None:
                     print(f"Malformed dialog example on page {url} does not have required speaker tag")
                     continue
 
                 # we must prefix hanzi, pinyin, and translation with this text
-                speaker_text = speaker_tag.get_text(strip=True)
-                speaker_tag.decompose()
+                speaker_text = get_stripped_text(speaker_tag)
+                speaker_tag.drop_tree()
                 if speaker_text is None:
                     print(f"Malformed dialog example on page {url} does not have required speaker labels")
                     continue
 
                 hanzi_text, pinyin_text, trans_text, expl_text = extract_and_decompose_li_components(li)
 
-                lines_hanzi.append(maybe_prepend_speaker_text(hanzi_text, speaker_text))
-                lines_pinyin.append(maybe_prepend_speaker_text(pinyin_text, speaker_text))
-                lines_trans.append(maybe_prepend_speaker_text(trans_text, speaker_text))
-                lines_expl.append(maybe_prepend_speaker_text(expl_text, speaker_text))
+                speakers.append(speaker_text)
+                lines_hanzi.append(hanzi_text)
+                lines_pinyin.append(pinyin_text)
+                lines_trans.append(trans_text)
+                lines_expl.append(expl_text)
 
-            # join all the lines with newlines
-            # remember Anki cards are rendered as HTML, use <br> not \n
-            hanzi_text = "<br>".join(lines_hanzi).strip()
-            pinyin_text = "<br>".join(filter(None, lines_pinyin))
-            trans_text = "<br>".join(filter(None, lines_trans))
-            expl_text = "<br>".join(filter(None, lines_expl))
+            hanzi_text = join_dialog_lines(speakers, lines_hanzi).strip()
+            pinyin_text = join_dialog_lines(speakers, lines_pinyin)
+            trans_text = join_dialog_lines(speakers, lines_trans)
+            expl_text = join_dialog_lines(speakers, lines_expl)
 
             # dialogs are always translations
-            model = TRANSLATION_MODEL
-
-            # check that required field is present
-            if hanzi_text is None:
-                print(f"Malformed example on page {url} does not have all required fields: hanzi: {hanzi_text}, pinyin: {pinyin_text}, translation: {trans_text}")
-                # skip and handle manually
-                continue
-
-            # validation checks:
-            # if no pinyin is included, add some, warning if there are any that have multiple pinyins
-            if pinyin_text is None:
-                pinyin_text = ''.join([item[0] for item in pinyin(hanzi_text, style=Style.TONE)])
-
-            parsed.append({"model":model,
-                            "hanzi":hanzi_text or "", # should never be None
-                            "pinyin":pinyin_text or "", # might be None for in-/valid example types
-                            "translation":trans_text or "", # might be None for in-/valid example types
-                            "notes":expl_text or "", # might be None if there is no explanation, which we just ignore
-                            "structure":structure or "", # should never be None
-                            "url":url,
-                            "article_title":title})
+            card = build_card(TRANSLATION_MODEL_ID, hanzi_text, pinyin_text, trans_text, expl_text, structure, url, title)
+            if card is not None:
+                parsed.append(card)
 
         else:
             for li in lis:
                 hanzi_text, pinyin_text, trans_text, expl_text = extract_and_decompose_li_components(li)
 
                 # determine the model from the example type
-                is_o_class = "o" in li.get('class', [])
-                is_x_class = "x" in li.get('class', [])
+                # split the class attribute once; lxml's .classes re-reads and splits it on every `in`
+                li_classes = li.get("class", "").split()
+                is_o_class = "o" in li_classes
+                is_x_class = "x" in li_classes
                 if is_o_class:
-                    model = VALID_EXAMPLE_MODEL
+                    model_id = VALID_EXAMPLE_MODEL_ID
                 elif is_x_class:
-                    model = INVALID_EXAMPLE_MODEL
+                    model_id = INVALID_EXAMPLE_MODEL_ID
                 else:
-                    model = TRANSLATION_MODEL
+                    model_id = TRANSLATION_MODEL_ID
 
-                # check that required field is present
-                if hanzi_text is None:
-                    print(f"Malformed example on page {url} does not have all required fields: hanzi: {hanzi_text}, pinyin: {pinyin_text}, translation: {trans_text}")
-                    # skip and handle manually
-                    continue
-
-                # validation checks:
-                # if no pinyin is included, add some, warning if there are any that have multiple pinyins
-                if pinyin_text is None:
-                    pinyin_text = ''.join([word[0] for word in pinyin(hanzi_text, style=Style.TONE)])
-
-                parsed.append({"model":model,
-                            "hanzi":hanzi_text or "", # should never be None
-                            "pinyin":pinyin_text or "", # might be None for in-/valid example types
-                            "translation":trans_text or "", # might be None for in-/valid example types
-                            "notes":expl_text or "", # might be None if there is no explanation, which we just ignore
-                            "structure":structure or "", # should never be None
-                            "url":url,
-                            "article_title":title})
+                card = build_card(model_id, hanzi_text, pinyin_text, trans_text, expl_text, structure, url, title)
+                if card is not None:
+                    parsed.append(card)
     return parsed
 
 
-def extract_and_decompose_li_components(li_tag: Tag) -> tuple[str, str | None, str | None, str | None]:
-    pinyin_tag = li_tag.find("span", class_="pinyin")
-    trans_tag = li_tag.find("span", class_="trans")
-    expl_tag = li_tag.find("span", class_="expl")
+def build_card(model_id: int, hanzi_text: str | None, pinyin_text: str | None, trans_text: str | None,
+               expl_text: str | None, structure: str, url: Url, title: str) -> CardContent | None:
+    """Validates the extracted example text and builds a card from it, or returns None if it's malformed."""
+    # check that required field is present
+    if hanzi_text is None:
+        print(f"Malformed example on page {url} does not have all required fields: hanzi: {hanzi_text}, pinyin: {pinyin_text}, translation: {trans_text}")
+        # skip and handle manually
+        return None
+
+    # validation checks:
+    # if no pinyin is included, add some, warning if there are any that have multiple pinyins
+    if pinyin_text is None:
+        pinyin_text = hanzi_to_pinyin(hanzi_text)
 
-    pinyin_text = maybe_get_tag_text_and_decompose(pinyin_tag)
-    trans_text = maybe_get_tag_text_and_decompose(trans_tag)
-    expl_text = maybe_get_tag_text_and_decompose(expl_tag)
+    # strip once here so the diff against an existing deck can compare fields as-is
+    return CardContent(model_id=model_id,
+                       hanzi=hanzi_text or "", # should never be None
+                       pinyin=(pinyin_text or "").strip(), # might be None for in-/valid example types
+                       translation=(trans_text or "").strip(), # might be None for in-/valid example types
+                       notes=(expl_text or "").strip(), # might be None if there is no explanation, which we just ignore
+                       structure=structure or "", # should never be None
+                       url=url,
+                       article_title=title)
 
-    hanzi_text = li_tag.get_text(strip=True).replace(' ', '')
+
+def extract_and_decompose_li_components(li_tag: HtmlElement | Tag) -> tuple[str, str | None, str | None, str | None]:
+    """Takes the pinyin, translation and explanation out of an example, leaving only the hanzi behind.
+
+    Works on both lxml elements (what the parser uses) and BeautifulSoup tags.
+    """
+    # sweep the spans once rather than running a separate find() per component
+    # like find(), the first span with a given class wins
+    if isinstance(li_tag, Tag):
+        spans_and_classes = ((span, span.get("class") or ()) for span in li_tag.find_all("span", class_=True))
+    else:
+        spans_and_classes = ((span, span.classes) for span in li_tag.iter("span"))
+    component_tags: dict[str, HtmlElement | Tag] = {}
+    for span, span_classes in spans_and_classes:
+        for span_class in span_classes:
+            if span_class in LI_COMPONENT_CLASSES:
+                component_tags.setdefault(span_class, span)
+
+    pinyin_text = maybe_get_tag_text_and_decompose(component_tags.get("pinyin"))
+    trans_text = maybe_get_tag_text_and_decompose(component_tags.get("trans"))
+    expl_text = maybe_get_tag_text_and_decompose(component_tags.get("expl"))
+
+    # drop all whitespace, including the full-width and non-breaking spaces common in CGW examples
+    li_text = li_tag.get_text() if isinstance(li_tag, Tag) else li_tag.text_content()
+    hanzi_text = WHITESPACE_RE.sub('', li_text)
 
     return hanzi_text, pinyin_text, trans_text, expl_text
 
 
-def maybe_get_tag_text_and_decompose(tag: Tag) -> str | None:
-    if tag:
+def maybe_get_tag_text_and_decompose(tag: HtmlElement | Tag | None) -> str | None:
+    if tag is None:
+        return None
+    if isinstance(tag, Tag):
         text = tag.get_text()
         tag.decompose()
-        return text
-    return None
+    else:
+        text = tag.text_content()
+        # unlike removing it from its parent, drop_tree() keeps the text that follows the element
+        tag.drop_tree()
+    return text
+
+
+def get_stripped_text(element: HtmlElement) -> str:
+    """Equivalent of BeautifulSoup's get_text(strip=True): every text node stripped, then joined without separators."""
+    return ''.join([text.strip() for text in element.itertext()])
+
+
+# bounded so a full scrape can't grow the cache without limit, while still catching examples repeated across pages
+@functools.lru_cache(maxsize=8192)
+def hanzi_to_pinyin(hanzi_text: str) -> str:
+    """Generates tone-marked pinyin for examples that don't include any, cached since examples repeat across pages."""
+    return ''.join([word[0] for word in pinyin(hanzi_text, style=Style.TONE)])
 
 
-def maybe_prepend_speaker_text(maybe_text: str | None, speaker_text: str):
+def join_dialog_lines(speakers: list[str], lines: Sequence[str | None]) -> str:
+    """Prefixes each dialog line with its speaker and joins them, skipping lines that are missing."""
+    # join all the lines with newlines
+    # remember Anki cards are rendered as HTML, use <br> not \n
+    return "<br>".join([f"{speaker} {line}" for speaker, line in zip(speakers, lines, strict=True) if line is not None])
+
+
+def maybe_prepend_speaker_text(maybe_text: str | None, speaker_text: str) -> str | None:
     return f"{speaker_text} {maybe_text}" if maybe_text is not None else maybe_text
 
 
-def get_existing_cards_from_deck(path_to_deck: str) -> dict[str, dict[str, str]]:
+def get_existing_cards_from_deck(path_to_deck: str) -> dict[str, PinyinAndTranslation]:
     """
-    Returns: { 'hanzi': { 'pinyin', 'translation'} }
+    Returns: { 'hanzi': ('pinyin', 'translation') }, with all values stripped
     """
     if not path_to_deck or not os.path.exists(path_to_deck):
         print(f"Could not find existing deck: {path_to_deck}")
         return {}
 
     print(f"Reading existing deck: {path_to_deck}...")
-    existing_data_snips = {}
+    existing_data_snips: dict[str, PinyinAndTranslation] = {}
 
     with tempfile.TemporaryDirectory() as temp_dir:
         try:
@@ -294,73 +439,89 @@ def get_existing_cards_from_deck(path_to_deck: str) -> dict[str, dict[str, str]]
             if not os.path.exists(db_path):
                 db_path = os.path.join(temp_dir, 'collection.anki21')
 
-            with sqlite3.connect(db_path) as conn:
-                cursor = conn.cursor()
+            # the extracted collection is a private copy that is only ever read,
+            # so open it immutable to skip SQLite's locking and journal checks
+            with closing(sqlite3.connect(f"{Path(db_path).as_uri()}?immutable=1", uri=True)) as conn:
+                # keep fields as raw bytes so we only pay to decode the ones we actually compare
+                conn.text_factory = bytes
                 # Fetch all notes (cards are linked to notes via the notes table)
-                cursor.execute("SELECT flds FROM notes")
-                rows = cursor.fetchall()
-                print(f"Fetched {len(rows)} from existing deck.")
-
-                for row in rows:
-                    # Anki fields are separated by 0x1f
-                    fields = row[0].split('\x1f')
+                # iterate the cursor directly rather than materializing every row with fetchall()
+                cursor = conn.execute("SELECT flds FROM notes")
+                row_count = 0
+                for row in cursor:
+                    row_count += 1
+                    # Anki fields are separated by 0x1f; only the first 3 are needed
+                    fields = row[0].split(b'\x1f', 3)
                     if fields:
-                        hanzi_key = fields[0].strip()
+                        hanzi_key = fields[0].decode().strip()
                         # Store relevant fields to check for changes - doesn't need to be all fields!
-                        existing_data_snips[hanzi_key] = {
-                            "pinyin": fields[1] if len(fields) > 1 else "",
-                            "translation": fields[2] if len(fields) > 2 else "",
-                        }
+                        # strip once here rather than on every comparison in the diff
+                        existing_data_snips[hanzi_key] = (
+                            fields[1].decode().strip() if len(fields) > 1 else "",
+                            fields[2].decode().strip() if len(fields) > 2 else "",
+                        )
+                print(f"Fetched {row_count} from existing deck.")
         except Exception as e:
             print(f"Warning: Could not read deck ({e}). Proceeding as if deck is empty.")
 
     return existing_data_snips
 
 
-def diff_existing_and_scraped(existing_cards, scraped_cards: list[CardContent]) -> tuple[list[CardContent], DeckDiffStats]:
+def diff_existing_and_scraped(existing_cards: dict[str, PinyinAndTranslation], scraped_cards: list[CardContent]) -> tuple[list[CardContent], DeckDiffStats]:
+    """Picks out the new and updated scraped cards, dropping repeats. Scraped cards are treated as read-only, so they're exported without copying."""
     cards_to_export: list[CardContent] = []
-    stats: DeckDiffStats = {"new": 0, "update": 0, "skipped": 0}
+    stats: DeckDiffStats = {"new": 0, "update": 0, "skipped": 0, "duplicate": 0}
+    # an example can appear more than once (e.g. on several pages), only the first is exported as they share a guid
+    seen_hanzi: set[str] = set()
     for card in scraped_cards:
-        hanzi = card["hanzi"]
+        if card.hanzi in seen_hanzi:
+            print(f"Skipping duplicate example {card.hanzi} on page {card.url}")
+            stats["duplicate"] += 1
+            continue
+        seen_hanzi.add(card.hanzi)
 
-        if hanzi not in existing_cards:
+        # a single lookup tells us both whether the card exists and what it currently holds
+        existing = existing_cards.get(card.hanzi)
+
+        if existing is None:
             cards_to_export.append(card)
             stats["new"] += 1
+        # both sides were stripped when they were read in, so whitespace can't cause false positives
+        elif (card.pinyin, card.translation) != existing:
+            cards_to_export.append(card)
+            stats["update"] += 1
         else:
-            existing = existing_cards[hanzi]
-            # strip whitespace to avoid false positives
-            if (card["translation"].strip() != existing["translation"].strip() or
-                    card["pinyin"].strip() != existing["pinyin"].strip()):
-                cards_to_export.append(card)
-                stats["update"] += 1
-            else:
-                stats["skipped"] += 1
+            stats["skipped"] += 1
     return cards_to_export, stats
 
 
 def write_to_anki_deck(anki_cards: list[CardContent], output_filename=DEFAULT_DECK_LOCATION):
+    """Writes the cards out as a deck. Repeated hanzi must already be dropped (see diff_existing_and_scraped)."""
     deck = genanki.Deck(DECK_ID, DECK_NAME)
-    for card in anki_cards:
-        note = genanki.Note(
-            model = card["model"],
+    # build the note list in one pass rather than N add_note() calls;
+    # keep the scrape order, as genanki's write order is the order Anki introduces new cards
+    deck.notes = [
+        genanki.Note(
+            model = get_model_by_id(card.model_id),
             # sort field is set by the model
             fields = [
-                card["hanzi"],
-                card["pinyin"],
-                card["translation"],
-                card["notes"],
-                card["structure"],
-                card["url"],
-                card["article_title"]
+                card.hanzi,
+                card.pinyin,
+                card.translation,
+                card.notes,
+                card.structure,
+                card.url,
+                card.article_title
             ],
             # allows determinisitic updating of cards
             # a more thorough implementation here might generate these in a better way
             # e.g. consider if we could use h/p/t and say that if any 2/3 match, then this is the same card:
             # this would allow CGW authors to e.g. fix errors in hanzi without losing card learning progress
             # likely this means the pinyin would change, but the gist is the same
-            guid = genanki.guid_for(card["hanzi"])
+            guid = genanki.guid_for(card.hanzi)
         )
-        deck.add_note(note)
+        for card in anki_cards
+    ]
     genanki.Package(deck).write_to_file(output_filename)
 
 
@@ -370,6 +531,7 @@ async def main():
     parser = argparse.ArgumentParser(description="Scrapes all examples from Chinese Grammar Wiki into a new or existing Anki deck")
     parser.add_argument('-d', '--deck', help="Path to existing .apkg deck to update with new examples. New deck is created if not specified.", default=None)
     parser.add_argument('-o', '--output', help=f"Output filename for new cards. Writes to \"{DEFAULT_DECK_LOCATION}\" if not specified.", default=DEFAULT_DECK_LOCATION)
+    parser.add_argument('-c', '--cache-dir', help="Directory to cache scraped pages in. Pages already in the cache are read from it instead of being fetched again; delete it to re-scrape. Pages are not cached if not specified.", default=None)
     parser.add_argument('-t', '--test', action='store_true', help="If enabled, only reads 1 grammar point from 1 page. Use for testing that script works on setup and debugging")
     parser.add_argument('--test-url', type=is_valid_cgw_url, help="If this option is set alongside the --test flag, then we will run the script only for the given page. Must be a valid Chinese Grammar Wiki grammar point URL", default=None)
     args = parser.parse_args()
@@ -379,6 +541,9 @@ async def main():
         parser.error("--test-url requires the --test flag to be set.")
 
     try:
+        # a saved session already carries the verification cookie, so we can skip waiting for Cloudflare
+        # check before starting the browser, since starting it creates the profile
+        needs_validation = not has_saved_browser_session()
         # start the browser - do this just once per script invocation to reuse the session & verification cookie
         browser = await open_browser()
 
@@ -387,23 +552,27 @@ async def main():
             point_urls: list[Url] = [args.test_url]
         else:
             # scrape all the levels pages
-            level_pages: list[UrlAndPageContent] = await get_with_verification(browser, LEVELS_URLS, args.test)
+            level_pages: list[UrlAndPageContent] = await get_with_verification(browser, LEVELS_URLS, args.test, args.cache_dir, needs_validation)
 
             # extact point page urls
             point_urls: list[Url] = parse_level_pages(level_pages)
+            del level_pages
 
         # scrape all the point pages
-        point_contents_raw: list[UrlAndPageContent] = await get_with_verification(browser, point_urls, args.test)
+        point_contents_raw: list[UrlAndPageContent] = await get_with_verification(browser, point_urls, args.test, args.cache_dir, needs_validation)
 
         # parse the point pages
         cards_to_export: list[CardContent] = parse_point_pages(point_contents_raw)
-        stats: DeckDiffStats = {"new": len(cards_to_export), "update": 0, "skipped": 0}
+        # the cards only hold plain strings, so drop the raw html before diffing & writing the deck
+        del point_contents_raw
 
         path_to_deck = args.deck
         # if an existing deck is being updated, understand which cards are present
+        existing_cards: dict[str, PinyinAndTranslation] = {}
         if path_to_deck is not None and os.path.exists(path_to_deck):
             existing_cards = get_existing_cards_from_deck(args.deck)
-            cards_to_export, stats = diff_existing_and_scraped(existing_cards, cards_to_export)
+        # always diff, even against an empty deck, so duplicate examples are dropped & counted
+        cards_to_export, stats = diff_existing_and_scraped(existing_cards, cards_to_export)
 
         if len(cards_to_export) == 0:
             print("Nothing to export!")
@@ -416,6 +585,7 @@ async def main():
         print(f"New Cards: {stats["new"]}")
         print(f"Updates:   {stats["update"]} (Content changed)")
         print(f"Skipped:   {stats["skipped"]} (Identical)")
+        print(f"Repeats:   {stats["duplicate"]} (Same hanzi as an earlier example)")
 
     finally:
         # Always close the browser at the end of the session
@@ -195,3 +195,9 @@ INVALID_EXAMPLE_MODEL = genanki.Model(
     css=STYLING,
     sort_field_index=0,
 )
+
+MODELS_BY_ID = {model.model_id: model for model in (TRANSLATION_MODEL, VALID_EXAMPLE_MODEL, INVALID_EXAMPLE_MODEL)}
+
+
+def get_model_by_id(model_id: int) -> genanki.Model:
+    return MODELS_BY_ID[model_id]
@@ -1,33 +1,39 @@
 import argparse
+import asyncio
+import copy
 from contextlib import nullcontext as does_not_raise
 
+import lxml.html
 import pytest
 from bs4 import BeautifulSoup
+from pypinyin import Style, pinyin
 
 import main
 from templates import INVALID_EXAMPLE_MODEL, TRANSLATION_MODEL, VALID_EXAMPLE_MODEL
 
-TEST_CARD_BASE = {
-    "model": TRANSLATION_MODEL,
-    "hanzi": "你好",
-    "pinyin": "nǐhǎo",
-    "translation": "Hello",
-    "notes": "A common greeting",
-    "structure": "你好 + [Name]",
-    "url": "https://resources.allsetlearning.com/chinese/grammar/ASDF1234",
-    "article_title": "Ways to greet someone"
-}
+TEST_CARD_BASE = main.CardContent(
+    model_id=TRANSLATION_MODEL.model_id,
+    hanzi="你好",
+    pinyin="nǐhǎo",
+    translation="Hello",
+    notes="A common greeting",
+    structure="你好 + [Name]",
+    url="https://resources.allsetlearning.com/chinese/grammar/ASDF1234",
+    article_title="Ways to greet someone"
+)
 
 
 @pytest.fixture
 def mock_soup_factory():
     def _create_soup(html_snippet):
-        return BeautifulSoup(html_snippet, 'html.parser')
+        return BeautifulSoup(html_snippet, 'lxml')
     return _create_soup
 
 
 @pytest.mark.parametrize("url, expectation", [
     ("https://resources.allsetlearning.com/chinese/grammar/ASGH4A7W", does_not_raise()),
+    ("https://resources.allsetlearning.com/chinese/grammar/Expressing_existence_in_a_place_with_%22zai%22", does_not_raise()),
+    ("https://resources.allsetlearning.com/chinese/grammar/", pytest.raises(argparse.ArgumentTypeError)), # No page
     ("https://resources.allsetlearning.com/chinese/grammar/A1_grammar_points", pytest.raises(argparse.ArgumentTypeError)),
     ("http://google.com", pytest.raises(argparse.ArgumentTypeError)), # Wrong domain
     ("not_a_url", pytest.raises(argparse.ArgumentTypeError))
@@ -56,6 +62,27 @@ def test_extract_and_decompose_li_components(mock_soup_factory):
     assert t == "I"
     assert e == "explanation"
 
+def test_extract_and_decompose_li_components_lxml():
+    li = lxml.html.fragment_fromstring("""<li>我<span class="pinyin">wǒ</span><span class="trans">I</span>。</li>""")
+
+    h, p, t, e = main.extract_and_decompose_li_components(li)
+
+    assert h == "我。" # text after a removed span is kept
+    assert p == "wǒ"
+    assert t == "I"
+    assert e is None
+    assert li.find("span") is None
+
+
+def test_extract_components_strips_all_whitespace(mock_soup_factory):
+    html = """<li>我\u3000是\u00a0学 生<span class="trans">I am a student</span></li>"""
+    soup = mock_soup_factory(html)
+    li = soup.find("li")
+
+    h, _, _, _ = main.extract_and_decompose_li_components(li)
+
+    assert h == "我是学生"
+
 def test_extract_components_missing_optional_fields(mock_soup_factory):
     html = """<li>我<span class="trans">I</span></li>"""
     soup = mock_soup_factory(html)
@@ -91,6 +118,63 @@ def test_maybe_prepend_speaker_text(maybe_text, speaker_text, expected_result):
     assert main.maybe_prepend_speaker_text(maybe_text, speaker_text) == expected_result
 
 
+def test_page_cache_round_trip(tmp_path):
+    main.append_to_page_cache(str(tmp_path), [{"url": "http://a.url", "content": "<html>A</html>"}])
+    main.append_to_page_cache(str(tmp_path), [{"url": "http://b.url", "content": "<html>你好</html>"}])
+
+    assert main.read_page_cache(str(tmp_path)) == {
+        "http://a.url": "<html>A</html>",
+        "http://b.url": "<html>你好</html>",
+    }
+
+
+def test_get_with_verification_uses_cache(tmp_path):
+    main.append_to_page_cache(str(tmp_path), [{"url": "http://a.url", "content": "<html>A</html>"}])
+
+    # everything is cached, so the browser is never touched
+    pages = asyncio.run(main.get_with_verification(None, ["http://a.url"], cache_dir=str(tmp_path)))
+
+    assert pages == [{"url": "http://a.url", "content": "<html>A</html>"}]
+
+
+def test_fetch_page_closes_tab_on_failure():
+    class MockPage:
+        closed = False
+        async def get_content(self):
+            raise TimeoutError
+        async def close(self):
+            self.closed = True
+
+    class MockBrowser:
+        page = MockPage()
+        async def get(self, url, new_tab=False):
+            return self.page
+
+    browser = MockBrowser()
+    with pytest.raises(TimeoutError):
+        asyncio.run(main.fetch_page(browser, "http://a.url", asyncio.Semaphore(1)))
+
+    assert browser.page.closed
+
+
+def test_get_with_verification_caches_pages_before_a_failed_fetch(tmp_path, monkeypatch):
+    async def mock_fetch_page(browser, url, semaphore, wait_for_validation=False):
+        if url == "http://c.url":
+            await asyncio.sleep(0) # let the other fetch finish first
+            raise TimeoutError(url)
+        return {"url": url, "content": f"<html>{url}</html>"}
+    monkeypatch.setattr(main, "fetch_page", mock_fetch_page)
+
+    urls = ["http://a.url", "http://b.url", "http://c.url"]
+    with pytest.raises(TimeoutError):
+        asyncio.run(main.get_with_verification(None, urls, cache_dir=str(tmp_path)))
+
+    assert main.read_page_cache(str(tmp_path)) == {
+        "http://a.url": "<html>http://a.url</html>",
+        "http://b.url": "<html>http://b.url</html>",
+    }
+
+
 def test_parse_level_pages(mock_soup_factory):
     html = """
     <html>
@@ -131,13 +215,47 @@ def test_parse_point_page_standard_examples(mock_soup_factory):
     assert len(cards) == 2
 
     # Check valid example
-    assert cards[0]["model"] == VALID_EXAMPLE_MODEL
-    assert cards[0]["hanzi"] == "好"
-    assert cards[0]["structure"] == "Structure + Verb"
+    assert cards[0].model_id == VALID_EXAMPLE_MODEL.model_id
+    assert cards[0].hanzi == "好"
+    assert cards[0].structure == "Structure + Verb"
 
     # Check invalid example
-    assert cards[1]["model"] == INVALID_EXAMPLE_MODEL
-    assert cards[1]["hanzi"] == "不好"
+    assert cards[1].model_id == INVALID_EXAMPLE_MODEL.model_id
+    assert cards[1].hanzi == "不好"
+
+def test_parse_point_page_uses_closest_structure():
+    html = """
+    <html>
+        <h1>Title</h1>
+        <div class="liju"><ul><li><span class="pinyin">hǎo</span>好</li></ul></div>
+        <div class="jiegou">First Struct</div>
+        <div class="liju"><ul><li><span class="pinyin">hǎo</span>好</li></ul></div>
+        <div class="jiegou">Second Struct</div>
+        <div class="liju"><ul><li><span class="pinyin">bù hǎo</span>不好</li></ul></div>
+    </html>
+    """
+    page_data = {"url": "http://test.url", "content": html}
+    cards = main.parse_point_page(page_data)
+
+    assert [card.structure for card in cards] == ["", "First Struct", "Second Struct"]
+
+def test_parse_point_page_ignores_script_and_style():
+    html = """
+    <html>
+        <h1>Title</h1>
+        <div class="liju">
+            <ul>
+                <li><span class="pinyin">hǎo<style>.a{}</style></span>好<script>var a=1;</script>了</li>
+            </ul>
+        </div>
+    </html>
+    """
+    page_data = {"url": "http://test.url", "content": html}
+    cards = main.parse_point_page(page_data)
+
+    assert cards[0].hanzi == "好了"
+    assert cards[0].pinyin == "hǎo"
+
 
 def test_parse_point_page_dialog(mock_soup_factory):
     html = """
@@ -164,10 +282,10 @@ def test_parse_point_page_dialog(mock_soup_factory):
     assert len(cards) == 1  # Dialogs should be aggregated into one card
     card = cards[0]
 
-    assert card["model"] == TRANSLATION_MODEL
-    assert card["hanzi"] == "A: 你好<br>B: 好"
-    assert card["translation"] == "A: Hello<br>B: Hi"
-    assert card["structure"] == "Dialog Struct"
+    assert card.model_id == TRANSLATION_MODEL.model_id
+    assert card.hanzi == "A: 你好<br>B: 好"
+    assert card.translation == "A: Hello<br>B: Hi"
+    assert card.structure == "Dialog Struct"
 
 
 def test_parse_point_page_fallback_pinyin(mock_soup_factory):
@@ -186,13 +304,43 @@ def test_parse_point_page_fallback_pinyin(mock_soup_factory):
     cards = main.parse_point_page(page_data)
 
     assert len(cards) == 1
-    assert "nǐ" in cards[0]["pinyin"]
-    assert "hǎo" in cards[0]["pinyin"]
+    assert "nǐ" in cards[0].pinyin
+    assert "hǎo" in cards[0].pinyin
+
+
+@pytest.mark.parametrize("hanzi_text", [
+    "我是学生。", # a full sentence, with punctuation
+    "我们国家", # a plain multi-character phrase
+    "银行", # 行 has several readings, resolved by pypinyin from the phrase
+    "我婆婆来", # 婆 has one reading alone, but is neutral in the phrase 婆婆
+    "abc 我 1", # non-hanzi passes through
+])
+def test_hanzi_to_pinyin_matches_pypinyin(hanzi_text):
+    expected = "".join(word[0] for word in pinyin(hanzi_text, style=Style.TONE))
+    assert main.hanzi_to_pinyin(hanzi_text) == expected
+
+
+def test_parse_point_pages_keeps_page_order():
+    html = """
+    <html>
+        <h1>{title}</h1>
+        <div class="liju">
+            <ul>
+                <li class="o"><span class="pinyin">hǎo</span><span class="trans">Good</span>好</li>
+            </ul>
+        </div>
+    </html>
+    """
+    page_data = [{"url": f"http://test.url/{i}", "content": html.format(title=f"Title {i}")} for i in range(20)]
+    cards = main.parse_point_pages(page_data)
+
+    assert [card.article_title for card in cards] == [f"Title {i}" for i in range(20)]
+    assert all(card.model_id == VALID_EXAMPLE_MODEL.model_id for card in cards)
 
 
 def test_diff_existing_and_scraped_all_new():
     existing = {}
-    scraped = [TEST_CARD_BASE.copy()]
+    scraped = [TEST_CARD_BASE]
 
     to_export, stats = main.diff_existing_and_scraped(existing, scraped)
 
@@ -205,12 +353,9 @@ def test_diff_existing_and_scraped_all_new():
 def test_diff_existing_and_scraped_identical_skip():
     # matches TEST_CARD_BASE
     existing = {
-        "你好": {
-            "pinyin": "nǐhǎo",
-            "translation": "Hello"
-        }
+        "你好": ("nǐhǎo", "Hello")
     }
-    scraped = [TEST_CARD_BASE.copy()]
+    scraped = [TEST_CARD_BASE]
 
     to_export, stats = main.diff_existing_and_scraped(existing, scraped)
 
@@ -222,12 +367,9 @@ def test_diff_existing_and_scraped_identical_skip():
 
 def test_diff_existing_and_scraped_update_translation():
     existing = {
-        "你好": {
-            "pinyin": "nǐhǎo",
-            "translation": "Old Translation"
-        }
+        "你好": ("nǐhǎo", "Old Translation")
     }
-    scraped = [TEST_CARD_BASE.copy()]
+    scraped = [TEST_CARD_BASE]
 
     to_export, stats = main.diff_existing_and_scraped(existing, scraped)
 
@@ -235,19 +377,16 @@ def test_diff_existing_and_scraped_update_translation():
     assert stats["new"] == 0
     assert stats["update"] == 1
     assert stats["skipped"] == 0
-    assert to_export[0]["translation"] == "Hello"
+    assert to_export[0].translation == "Hello"
 
 
 def test_diff_existing_and_scraped_ignores_whitespace():
     """Ensure trimming works so we don't update just for spaces."""
     existing = {
-        "你好": {
-            "pinyin": "nǐhǎo ", # trailing space
-            "translation": "Hello"
-        }
+        "你好": ("nǐhǎo", "Hello")
     }
-    scraped_card = TEST_CARD_BASE.copy()
-    scraped_card["pinyin"] = "nǐhǎo"
+    # cards are normalized as they're built, so build it the way the parser does
+    scraped_card = main.build_card(TRANSLATION_MODEL.model_id, "你好", "nǐhǎo ", " Hello", None, "", "http://test.url", "Title") # stray spaces
     scraped = [scraped_card]
 
     to_export, stats = main.diff_existing_and_scraped(existing, scraped)
@@ -256,6 +395,22 @@ def test_diff_existing_and_scraped_ignores_whitespace():
     assert stats["skipped"] == 1
 
 
+def test_diff_existing_and_scraped_skips_duplicate_hanzi():
+    existing = {
+        "你好": ("nǐhǎo", "Old Translation")
+    }
+    duplicate_card = copy.copy(TEST_CARD_BASE)
+    duplicate_card.translation = "Hi"
+    scraped = [TEST_CARD_BASE, duplicate_card]
+
+    to_export, stats = main.diff_existing_and_scraped(existing, scraped)
+
+    # the first card with a given hanzi wins, and the repeat isn't counted as an update
+    assert to_export == [TEST_CARD_BASE]
+    assert stats["update"] == 1
+    assert stats["duplicate"] == 1
+
+
 def test_write_to_anki_deck(tmp_path):
     test_path = tmp_path / "test_deck.apkg"
     main.write_to_anki_deck([TEST_CARD_BASE], test_path)
@@ -263,3 +418,15 @@ def test_write_to_anki_deck(tmp_path):
     assert test_path.exists()
 
 
+def test_get_existing_cards_from_deck(tmp_path):
+    test_path = tmp_path / "test_deck.apkg"
+    card = copy.copy(TEST_CARD_BASE)
+    card.pinyin = "nǐhǎo " # trailing space
+    main.write_to_anki_deck([card], test_path)
+
+    existing = main.get_existing_cards_from_deck(str(test_path))
+
+    # values are stripped on load
+    assert existing == {
+        "你好": ("nǐhǎo", "Hello")
+    }